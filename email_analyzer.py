@@ -1,14 +1,26 @@
 import os
 import time
+import random
+import asyncio
+import heapq
+import re
 import json
+import shelve
+import hashlib
+from itertools import islice
 from datetime import datetime, timedelta, time as dt_time
 import streamlit as st
 import tempfile
+import httplib2
+import google_auth_httplib2
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google.auth.exceptions import RefreshError
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 import openai
+from cryptography.fernet import Fernet, InvalidToken
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -17,21 +29,135 @@ load_dotenv()  # Loads variables from .env into the environment
 # Gmail integration scopes
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
+# Local storage for the encrypted Gmail refresh token (single-user runs only) and cached analyses,
+# so reruns can skip re-work
+APP_DIR = os.path.join(os.path.expanduser("~"), ".email_analyzer")
+TOKEN_PATH = os.path.join(APP_DIR, "token.enc")
+ANALYSIS_CACHE_PATH = os.path.join(APP_DIR, "analysis_cache")
+HTTP_CACHE_DIR = os.path.join(APP_DIR, "http_cache")
+
+# Attempts for Gmail batch items that fail with a rate limit or server error
+GMAIL_BATCH_RETRIES = 3
+
+# Number of email snippets packed into a single chat completion request
+EMAILS_PER_REQUEST = 15
+
+ANALYSIS_SYSTEM_PROMPT = "You are an expert in extracting structured information from client emails."
+
+# Emails whose snippet alone pre-scores at or above the threshold get the stronger model
+ANALYSIS_MODEL = "gpt-4-turbo"
+TRIAGE_MODEL = "gpt-4o-mini"
+HIGH_PRIORITY_THRESHOLD = 5
+
+# Number of top-priority emails shown while analysis is still running
+LIVE_PREVIEW_COUNT = 10
+
+# Minimum seconds between progress updates, since each one is a round-trip to the browser
+UI_UPDATE_INTERVAL = 0.2
+
+# Priority scoring
+# Matched against casefolded text
+URGENCY_RE = re.compile(r"\b(urgent|asap|immediately|critical|emergency|deadline|rush)\w*")
+HIGH_PRIORITY_DOMAINS = ("@acme.com", "@important-client.com")
+
 openai.api_key = os.getenv("OPENAI_API_KEY", "")
 if not openai.api_key and "openai" in st.secrets:
     openai.api_key = st.secrets["openai"]["api_key"]
 
+def _token_fernet():
+    """
+    Returns the Fernet used to encrypt the saved refresh token, or None if the token should not be saved.
+    The token is only saved when EMAIL_ANALYZER_SINGLE_USER is set, since a hosted app would
+    share the one token file between all of its users.
+    """
+    if not os.getenv("EMAIL_ANALYZER_SINGLE_USER"):
+        return None
+    # Validate the key once per session; an invalid key disables persistence
+    if "token_fernet" not in st.session_state:
+        key = os.getenv("EMAIL_ANALYZER_TOKEN_KEY", "")
+        if not key and "token" in st.secrets:
+            key = st.secrets["token"]["key"]
+        fernet = None
+        if key:
+            try:
+                fernet = Fernet(key)
+            except ValueError:
+                st.warning("The Gmail token encryption key is not a valid Fernet key. Credentials will not be saved.")
+        st.session_state.token_fernet = fernet
+    return st.session_state.token_fernet
+
+def load_gmail_creds():
+    """
+    Rebuilds Gmail credentials from the encrypted refresh token saved by a previous session.
+    Takes a single token refresh instead of the interactive OAuth flow.
+    """
+    fernet = _token_fernet()
+    if not fernet or not os.path.exists(TOKEN_PATH):
+        return None
+    try:
+        with open(TOKEN_PATH, "rb") as f:
+            refresh_token = fernet.decrypt(f.read()).decode("utf-8")
+
+        client_config = json.loads(st.secrets["gcp"]["client_config"])
+        client = client_config.get("web") or client_config["installed"]
+        creds = Credentials(
+            token=None,
+            refresh_token=refresh_token,
+            client_id=client["client_id"],
+            client_secret=client["client_secret"],
+            token_uri=client["token_uri"],
+            scopes=SCOPES,
+        )
+        creds.refresh(Request())
+        return creds
+    except (InvalidToken, RefreshError):
+        # Rotated key or revoked token; drop the file so later starts skip the failed refresh
+        clear_gmail_creds()
+        return None
+    except Exception:
+        return None
+
+def save_gmail_creds(creds):
+    """
+    Saves the encrypted refresh token to disk so later sessions can skip the OAuth flow.
+    Nothing is saved unless single-user mode and an encryption key are configured.
+    """
+    fernet = _token_fernet()
+    if not fernet or not creds.refresh_token:
+        return
+    try:
+        os.makedirs(APP_DIR, exist_ok=True)
+        with open(TOKEN_PATH, "wb") as f:
+            f.write(fernet.encrypt(creds.refresh_token.encode("utf-8")))
+    except OSError as e:
+        st.warning(f"Could not save Gmail credentials: {str(e)}")
+
+def clear_gmail_creds():
+    """
+    Removes saved Gmail credentials from disk.
+    """
+    try:
+        os.remove(TOKEN_PATH)
+    except FileNotFoundError:
+        pass
+
 def get_gmail_service():
     """
     Handles Gmail authentication flow through Google OAuth.
     Uses Streamlit session state to maintain credentials between reruns.
     """
     # Debug tab to help troubleshoot authentication issues
-    with st.expander("Authentication Debugging (Expand if having issues)"):
-        st.write("Session state keys:", list(st.session_state.keys()))
-        query_params = st.query_params
-        st.write("Query parameters:", query_params)
+    if os.getenv("EMAIL_ANALYZER_DEBUG"):
+        with st.expander("Authentication Debugging (Expand if having issues)"):
+            st.write("Session state keys:", list(st.session_state.keys()))
+            st.write("Query parameters:", st.query_params)
     
+    # Restore credentials saved by a previous session
+    if "gmail_creds" not in st.session_state:
+        stored_creds = load_gmail_creds()
+        if stored_creds:
+            st.session_state.gmail_creds = stored_creds
+
     # Check if we already have credentials
     if "gmail_creds" in st.session_state:
         creds = st.session_state.gmail_creds
@@ -40,10 +166,12 @@ def get_gmail_service():
             try:
                 creds.refresh(Request())
                 st.session_state.gmail_creds = creds
+                save_gmail_creds(creds)
             except Exception as e:
                 st.error(f"Error refreshing credentials: {e}")
                 # Clear credentials to restart auth flow
                 del st.session_state.gmail_creds
+                clear_gmail_creds()
                 st.rerun()
     else:
         # Load client config from Streamlit secrets
@@ -59,8 +187,6 @@ def get_gmail_service():
             # Use the hardcoded redirect URI that matches your Google Cloud Console configuration
             redirect_uri = "https://emailanalyzer-jeepcuohhmah2mqp8x3gqb.streamlit.app/"
             
-            st.write(f"Using redirect URI: {redirect_uri}")
-            
             # Create the OAuth flow
             flow = InstalledAppFlow.from_client_secrets_file(
                 temp_path,
@@ -79,6 +205,7 @@ def get_gmail_service():
                     # Exchange code for tokens
                     flow.fetch_token(code=code)
                     st.session_state.gmail_creds = flow.credentials
+                    save_gmail_creds(flow.credentials)
                     
                     # Clean up the URL by removing the query parameters
                     # Note: This might not work in all Streamlit environments
@@ -109,32 +236,50 @@ def get_gmail_service():
             st.stop()
 
     try:
-        # Build the Gmail service with our credentials
-        service = build('gmail', 'v1', credentials=st.session_state.gmail_creds)
+        # Build the Gmail service on a single authorized Http so all calls reuse its connections
+        authed_http = google_auth_httplib2.AuthorizedHttp(
+            st.session_state.gmail_creds,
+            http=httplib2.Http(cache=HTTP_CACHE_DIR, timeout=30),
+        )
+        service = build('gmail', 'v1', http=authed_http, cache_discovery=False)
         return service
     except Exception as e:
         st.error(f"Error building Gmail service: {str(e)}")
         # Clear credentials to restart auth flow
         if "gmail_creds" in st.session_state:
             del st.session_state.gmail_creds
+        clear_gmail_creds()
         st.stop()
 
 def fetch_recent_emails(service, start_datetime, end_datetime, desired_count=50, max_fetch=200):
     """
-    Fetch emails by scanning up to max_fetch messages and returning those whose internalDate
-    falls between start_datetime and end_datetime.
+    Fetch up to desired_count emails received between start_datetime and end_datetime.
+    The date range is filtered server-side by Gmail, scanning at most max_fetch messages.
     """
     matching_emails = []
     next_page_token = None
     fetched_messages = 0
 
+    # Gmail's before: is exclusive, so add a second to keep end_datetime inclusive
+    after = int(start_datetime.timestamp())
+    before = int(end_datetime.timestamp()) + 1
+
+    # Exact bounds in epoch milliseconds, comparable with internalDate without building datetimes
+    start_ms = int(start_datetime.timestamp() * 1000)
+    end_ms = int(end_datetime.timestamp() * 1000)
+
     progress_bar = st.progress(0)
     status_text = st.empty()
     status_text.write("Fetching emails...")
+    last_ui = 0.0
     
     try:
         while fetched_messages < max_fetch and len(matching_emails) < desired_count:
-            params = {"userId": "me", "maxResults": 50}
+            params = {
+                "userId": "me",
+                "maxResults": min(50, desired_count - len(matching_emails)),
+                "q": f"after:{after} before:{before}",
+            }
             if next_page_token:
                 params["pageToken"] = next_page_token
             
@@ -145,37 +290,85 @@ def fetch_recent_emails(service, start_datetime, end_datetime, desired_count=50,
             if not messages:
                 break
                 
-            for i, msg in enumerate(messages):
-                progress_bar.progress(min(1.0, fetched_messages / max_fetch))
-                status_text.write(f"Fetching emails... ({fetched_messages} scanned, {len(matching_emails)} matched)")
-                
+            # Results for this page, keyed by message id so retried items keep their order
+            page_emails = {}
+            retryable = {}
+
+            def _on_msg(request_id, response, exception):
+                nonlocal last_ui
+                if exception is not None:
+                    if isinstance(exception, HttpError) and exception.resp.status in (429, 500, 503):
+                        retryable[request_id] = exception
+                    else:
+                        st.warning(f"Error processing an email: {str(exception)}")
+                    return
+
+                if time.monotonic() - last_ui > UI_UPDATE_INTERVAL:
+                    progress_bar.progress(min(1.0, fetched_messages / max_fetch))
+                    matched = len(matching_emails) + len(page_emails)
+                    status_text.write(f"Fetching emails... ({fetched_messages} scanned, {matched} matched)")
+                    last_ui = time.monotonic()
+
                 try:
-                    msg_data = service.users().messages().get(userId="me", id=msg["id"]).execute()
-                    # internalDate is in milliseconds since epoch
-                    internal_date = int(msg_data.get("internalDate", 0))
+                    # internalDate is in milliseconds since epoch; Gmail's q filter only
+                    # has second granularity, so trim anything just outside the range
+                    internal_date = int(response.get("internalDate", 0))
+                    if not start_ms <= internal_date <= end_ms:
+                        return
                     email_datetime = datetime.fromtimestamp(internal_date / 1000)
-                    
-                    # Check if email is within the desired range
-                    if start_datetime <= email_datetime <= end_datetime:
-                        snippet = msg_data.get("snippet", "")
-                        headers = msg_data["payload"].get("headers", [])
-                        subject = next((h["value"] for h in headers if h["name"] == "Subject"), "No Subject")
-                        sender = next((h["value"] for h in headers if h["name"] == "From"), "Unknown Sender")
-                        
-                        matching_emails.append({
-                            "id": msg["id"],
-                            "subject": subject,
-                            "from": sender,
-                            "snippet": snippet,
-                            "received_at": email_datetime,
-                        })
-                        
-                        if len(matching_emails) >= desired_count:
-                            break
+
+                    snippet = response.get("snippet", "")
+                    headers = response["payload"].get("headers", [])
+                    hmap = {h["name"]: h["value"] for h in headers}
+                    subject = hmap.get("Subject", "No Subject")
+                    sender = hmap.get("From", "Unknown Sender")
+
+                    page_emails[request_id] = {
+                        "id": request_id,
+                        "subject": subject,
+                        "from": sender,
+                        "snippet": snippet,
+                        "received_at": email_datetime,
+                    }
                 except Exception as e:
                     st.warning(f"Error processing an email: {str(e)}")
-                    continue
-                    
+
+            # Fetch the whole page of messages in a single batched HTTP round-trip,
+            # re-batching items that were rate limited with backoff
+            pending = [msg["id"] for msg in messages]
+            for attempt in range(GMAIL_BATCH_RETRIES):
+                if attempt > 0:
+                    # Full-jitter exponential backoff before re-batching
+                    time.sleep(random.uniform(0, 2 ** attempt))
+                retryable.clear()
+
+                batch = service.new_batch_http_request(callback=_on_msg)
+                for msg_id in pending:
+                    batch.add(
+                        service.users().messages().get(
+                            userId="me",
+                            id=msg_id,
+                            format="metadata",
+                            metadataHeaders=["Subject", "From"],
+                        ),
+                        request_id=msg_id,
+                    )
+                batch.execute()
+
+                pending = list(retryable)
+                if not pending:
+                    break
+
+            for exception in retryable.values():
+                st.warning(f"Error processing an email: {str(exception)}")
+
+            for msg in messages:
+                if msg["id"] in page_emails and len(matching_emails) < desired_count:
+                    matching_emails.append(page_emails[msg["id"]])
+
+            if len(matching_emails) >= desired_count:
+                break
+
             next_page_token = result.get("nextPageToken")
             if not next_page_token:
                 break
@@ -189,65 +382,295 @@ def fetch_recent_emails(service, start_datetime, end_datetime, desired_count=50,
 
 
 
-# Then update the analyze_email_openai function to better handle missing API key
-def analyze_email_openai(email_text: str) -> str:
+def select_model(email) -> str:
     """
-    Uses OpenAI's ChatCompletion to extract structured info from an email.
+    Picks the model for an email from a cheap priority pre-score on its snippet.
     """
-    if not openai.api_key:
-        st.error("OpenAI API key not configured. Please add it to your secrets.toml file.")
-        return "API key missing - unable to analyze email content."
-    
+    if compute_priority(email, email["snippet"]) >= HIGH_PRIORITY_THRESHOLD:
+        return ANALYSIS_MODEL
+    return TRIAGE_MODEL
+
+def build_analysis_request(email_text: str, model: str = ANALYSIS_MODEL) -> dict:
+    """
+    Builds the chat completions request body used to analyze a single email.
+    """
+    prompt = f"Extract service-request details:\n{email_text}"
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": 200,
+        "temperature": 0.3,
+        "top_p": 0.95,
+        "frequency_penalty": 0,
+        "presence_penalty": 0,
+    }
+
+def build_multi_analysis_request(snippets: list[str], model: str = ANALYSIS_MODEL) -> dict:
+    """
+    Builds a single chat completions request body that analyzes several emails at once.
+    The model is asked to answer with a JSON object whose 'results' are keyed by email number.
+    """
+    numbered = "\n\n".join(f"[{i}] {snippet}" for i, snippet in enumerate(snippets, start=1))
     prompt = (
-        f"Extract all relevant details for a service request from the email below:\n\n"
-        f"{email_text}\n\n"
-        "Return the extracted information in a clear, structured format."
+        "Extract service-request details for each email below. "
+        "Return a JSON object with key 'results' holding an array of objects, one per email, "
+        "each with key 'id' (the email number) and key 'details' (the extracted information as text).\n\n"
+        f"{numbered}"
     )
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "response_format": {"type": "json_object"},
+        "max_tokens": 200 * len(snippets),
+        "temperature": 0.3,
+        "top_p": 0.95,
+        "frequency_penalty": 0,
+        "presence_penalty": 0,
+    }
+
+def parse_multi_analysis(content: str, count: int) -> list[str]:
+    """
+    Maps the JSON answer to a multi-email request back to one analysis per email, in order.
+    """
+    details_by_id = {}
+    for item in json.loads(content).get("results", []):
+        # Skip malformed items; their emails fall back to "no result returned"
+        if not isinstance(item, dict):
+            continue
+        try:
+            email_id = int(item["id"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        details = item.get("details", "")
+        if not isinstance(details, str):
+            details = json.dumps(details, indent=2)
+        details_by_id[email_id] = details.strip()
+    return [details_by_id.get(i, "Error analyzing email: no result returned") for i in range(1, count + 1)]
+
+async def analyze_emails_openai(client: openai.AsyncOpenAI, snippets: list[str], model: str = ANALYSIS_MODEL) -> list[str]:
+    """
+    Uses OpenAI's chat completions to extract structured info from several emails in one request.
+    """
+    if not openai.api_key:
+        st.error("OpenAI API key not configured. Please add it to your secrets.toml file.")
+        return ["API key missing - unable to analyze email content."] * len(snippets)
     
     max_retries = 3
-    wait_time = 2  # seconds
     
     for attempt in range(max_retries):
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4-turbo",
-                messages=[
-                    {"role": "system", "content": "You are an expert in extracting structured information from client emails."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=200,
-                temperature=0.3,
-                top_p=0.95,
-                frequency_penalty=0,
-                presence_penalty=0,
-            )
-            return response.choices[0].message.content.strip()
+            response = await client.chat.completions.create(**build_multi_analysis_request(snippets, model))
+            return parse_multi_analysis(response.choices[0].message.content, len(snippets))
         except Exception as e:
             if attempt < max_retries - 1:
-                st.warning(f"OpenAI API error: {str(e)}. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-                wait_time *= 2  # Exponential backoff
+                wait_time = _retry_delay(e, attempt)
+                st.warning(f"OpenAI API error: {str(e)}. Retrying in {wait_time:.1f} seconds...")
+                await asyncio.sleep(wait_time)
             else:
-                st.error(f"Failed to analyze email after {max_retries} attempts: {str(e)}")
-                return f"Error analyzing email: {str(e)}"
+                st.error(f"Failed to analyze emails after {max_retries} attempts: {str(e)}")
+                return [f"Error analyzing email: {str(e)}"] * len(snippets)
+
+def _retry_delay(error: Exception, attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """
+    Full-jitter exponential backoff. Rate limit and overload errors honor the
+    server-supplied Retry-After header as a lower bound.
+    """
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if isinstance(error, openai.APIStatusError) and error.status_code in (429, 503):
+        retry_after = error.response.headers.get("retry-after")
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+    return delay
+
+def _chunked(items, size):
+    it = iter(items)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+async def _bounded(sem, coro):
+    async with sem:
+        return await coro
+
+async def _analyze_chunk(client, chunk, model):
+    try:
+        return chunk, await analyze_emails_openai(client, [e["snippet"] for e in chunk], model)
+    except Exception as e:
+        return chunk, [e] * len(chunk)
+
+async def stream_analyses(emails, on_result, concurrency=10):
+    """
+    Analyzes all emails in chunks of EMAILS_PER_REQUEST, with at most `concurrency`
+    OpenAI requests in flight. Each chunk only holds emails routed to the same model.
+    Calls on_result(email, analysis) as soon as each chunk completes.
+    """
+    by_model = {}
+    for email in emails:
+        by_model.setdefault(select_model(email), []).append(email)
+
+    # Retries are handled by analyze_emails_openai with full-jitter backoff, not by the SDK
+    client = openai.AsyncOpenAI(api_key=openai.api_key, max_retries=0)
+    sem = asyncio.Semaphore(concurrency)
+    tasks = [
+        _bounded(sem, _analyze_chunk(client, chunk, model))
+        for model, group in by_model.items()
+        for chunk in _chunked(group, EMAILS_PER_REQUEST)
+    ]
+    try:
+        for future in asyncio.as_completed(tasks):
+            chunk, results = await future
+            for email, analysis in zip(chunk, results):
+                on_result(email, analysis)
+    finally:
+        await client.close()
+
+def _submit_batch(client, emails, model):
+    lines = [
+        json.dumps({
+            "custom_id": email["id"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_analysis_request(email["snippet"], model),
+        })
+        for email in emails
+    ]
+    input_file = client.files.create(
+        file=("emails.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
+    )
+    return client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+
+def _wait_for_batch(client, batch, status_text, max_poll_interval):
+    # Poll with exponential backoff until the batch reaches a terminal state
+    wait_time = 2  # seconds
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        status_text.write(f"Waiting for OpenAI batch {batch.id} ({batch.status})...")
+        time.sleep(wait_time)
+        wait_time = min(wait_time * 2, max_poll_interval)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} finished with status '{batch.status}'")
+
+    results = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        if item.get("error") or response.get("status_code") != 200:
+            error = item.get("error") or response.get("body", {}).get("error")
+            results[item["custom_id"]] = f"Error analyzing email: {error}"
+        else:
+            content = response["body"]["choices"][0]["message"]["content"]
+            results[item["custom_id"]] = content.strip()
+    return results
+
+def analyze_emails_batch(emails, max_poll_interval=60):
+    """
+    Submits all emails to the OpenAI Batch API and waits for the results.
+    A batch only accepts one model, so one batch is submitted per model.
+    Cheaper than stream_analyses, but may take minutes to complete.
+    Results are returned in the same order as `emails`.
+    """
+    if not openai.api_key:
+        st.error("OpenAI API key not configured. Please add it to your secrets.toml file.")
+        return ["API key missing - unable to analyze email content."] * len(emails)
+
+    client = openai.OpenAI(api_key=openai.api_key)
+    status_text = st.empty()
+
+    by_model = {}
+    for email in emails:
+        by_model.setdefault(select_model(email), []).append(email)
+
+    # Submit every batch before polling so they are processed side by side
+    results = {}
+    batches = []
+    failed = False
+    for model, group in by_model.items():
+        try:
+            batches.append((group, _submit_batch(client, group, model)))
+        except Exception as e:
+            failed = True
+            status_text.error(f"Error running OpenAI batch: {str(e)}")
+            results.update({email["id"]: f"Error analyzing email: {str(e)}" for email in group})
+
+    for group, batch in batches:
+        try:
+            results.update(_wait_for_batch(client, batch, status_text, max_poll_interval))
+        except Exception as e:
+            failed = True
+            status_text.error(f"Error running OpenAI batch: {str(e)}")
+            results.update({email["id"]: f"Error analyzing email: {str(e)}" for email in group})
+
+    if not failed:
+        status_text.empty()
+    return [results.get(email["id"], "Error analyzing email: no result returned") for email in emails]
+
+def _analysis_cache_key(email):
+    snippet_hash = hashlib.sha256(email["snippet"].encode("utf-8")).hexdigest()
+    return f"{email['id']}:{snippet_hash}"
+
+def _is_analysis_error(analysis):
+    return isinstance(analysis, Exception) or analysis.startswith(("Error analyzing email", "API key missing"))
+
+def load_cached_analyses(emails):
+    """
+    Returns the cached analyses for `emails`, keyed by cache key.
+    """
+    try:
+        os.makedirs(APP_DIR, exist_ok=True)
+        with shelve.open(ANALYSIS_CACHE_PATH) as cache:
+            keys = (_analysis_cache_key(email) for email in emails)
+            return {key: cache[key] for key in keys if key in cache}
+    except Exception as e:
+        st.warning(f"Could not read analysis cache: {str(e)}")
+        return {}
+
+def store_analyses(results):
+    """
+    Caches successful analyses from (email, analysis) pairs so later runs can skip the OpenAI call.
+    """
+    try:
+        os.makedirs(APP_DIR, exist_ok=True)
+        with shelve.open(ANALYSIS_CACHE_PATH) as cache:
+            for email, analysis in results:
+                if not _is_analysis_error(analysis):
+                    cache[_analysis_cache_key(email)] = analysis
+    except Exception as e:
+        st.warning(f"Could not write analysis cache: {str(e)}")
 
 def compute_priority(email, extracted_info):
-    # Calculate urgency score by counting urgency-related keywords in the extracted info.
-    urgency_keywords = ['urgent', 'asap', 'immediately', 'critical', 'emergency', 'deadline', 'rush']
-    urgency_score = sum(1 for word in urgency_keywords if word in extracted_info.lower())
+    info_l = extracted_info.casefold()
+    from_l = email["from"].casefold()
+    subj_l = email["subject"].casefold()
+
+    # Calculate urgency score by counting distinct urgency-related keywords in the extracted info.
+    urgency_score = len(set(URGENCY_RE.findall(info_l)))
     
     # If the email is from PWC, give it a high bonus to ensure it is prioritized.
-    from_field = email["from"].lower()
     bonus = 0
     
     # Check for high-priority senders
-    if "pwc" in from_field:
+    if "pwc" in from_l:
         bonus = 100
-    elif any(domain in from_field for domain in ["@acme.com", "@important-client.com"]):
+    elif any(domain in from_l for domain in HIGH_PRIORITY_DOMAINS):
         bonus = 50
         
     # Check for urgency in subject
-    subject_urgency = sum(1 for word in urgency_keywords if word in email["subject"].lower())
+    subject_urgency = len(set(URGENCY_RE.findall(subj_l)))
     
     total_score = bonus + (urgency_score * 2) + (subject_urgency * 3)
     return total_score
@@ -277,6 +700,7 @@ def main():
         if "gmail_creds" in st.session_state:
             if st.button("Logout from Google"):
                 del st.session_state.gmail_creds
+                clear_gmail_creds()
                 st.success("Logged out successfully!")
                 st.rerun()
     
@@ -305,6 +729,7 @@ def main():
 
     # Options for analysis
     max_emails = st.slider("Maximum emails to analyze", min_value=5, max_value=100, value=20)
+    use_batch_api = st.checkbox("Use Batch API (cheaper, slower)")
     
     if st.button("Run Analysis", type="primary"):
         try:
@@ -325,31 +750,65 @@ def main():
                 st.info("No emails found in the selected date/time range.")
                 return
 
-            # Process the emails with OpenAI
-            processed_emails = []
+            # Process the emails with OpenAI, keeping a max-heap of results keyed on priority
+            # so the highest-priority emails can be shown while the rest are still running
+            heap = []
+            order = {email["id"]: i for i, email in enumerate(emails)}
             progress_bar = st.progress(0)
-            analysis_status = st.empty()
-            
-            for i, email in enumerate(emails):
-                progress = (i + 1) / len(emails)
-                progress_bar.progress(progress)
-                analysis_status.write(f"Processing email {i+1} of {len(emails)}: {email['subject']}")
-                
-                analysis = analyze_email_openai(email["snippet"])
+            live_view = st.empty()
+            last_ui = 0.0
+
+            def add_result(email, analysis):
+                nonlocal last_ui
+                if isinstance(analysis, Exception):
+                    analysis = f"Error analyzing email: {str(analysis)}"
                 priority = compute_priority(email, analysis)
                 
                 email.update({
                     "analysis": analysis,
                     "priority": priority,
                 })
-                processed_emails.append(email)
+                heapq.heappush(heap, (-priority, order[email["id"]], email))
+
+                if time.monotonic() - last_ui > UI_UPDATE_INTERVAL:
+                    progress_bar.progress(len(heap) / len(emails))
+                    live_view.dataframe(
+                        [
+                            {"Priority": e["priority"], "Subject": e["subject"], "From": e["from"]}
+                            for _, _, e in heapq.nsmallest(LIVE_PREVIEW_COUNT, heap)
+                        ],
+                        use_container_width=True,
+                    )
+                    last_ui = time.monotonic()
+
+            analyses = load_cached_analyses(emails)
+            pending = []
+            for email in emails:
+                key = _analysis_cache_key(email)
+                if key in analyses:
+                    add_result(email, analyses[key])
+                else:
+                    pending.append(email)
+
+            if pending:
+                completed = []
+                def on_result(email, analysis):
+                    completed.append((email, analysis))
+                    add_result(email, analysis)
+
+                with st.spinner(f"Analyzing {len(pending)} emails with OpenAI..."):
+                    if use_batch_api:
+                        for email, analysis in zip(pending, analyze_emails_batch(pending)):
+                            on_result(email, analysis)
+                    else:
+                        asyncio.run(stream_analyses(pending, on_result))
+                store_analyses(completed)
             
-            # Sort emails by priority
-            sorted_emails = sorted(processed_emails, key=lambda x: x["priority"], reverse=True)
+            sorted_emails = [email for _, _, email in sorted(heap)]
             
             # Clear progress indicators
             progress_bar.empty()
-            analysis_status.empty()
+            live_view.empty()
             
             # Display results
             st.success(f"Analysis complete! Analyzed {len(emails)} emails.")